@@ -0,0 +1,23 @@
+"""
+Parallel numba kernels used by the proximal operators
+
+"""
+import numba
+
+
+@numba.njit(parallel=True, cache=True)
+def soft_threshold(x, lmbda, out):
+    for i in numba.prange(x.size):
+        # NaN fails every comparison and falls through to the last branch
+        if abs(x[i]) <= lmbda:
+            out[i] = 0.
+        elif x[i] > 0.:
+            out[i] = x[i] - lmbda
+        else:
+            out[i] = x[i] + lmbda
+
+
+@numba.njit(parallel=True, cache=True)
+def clip_negative(x, out):
+    for i in numba.prange(x.size):
+        out[i] = 0. if x[i] < 0. else x[i]
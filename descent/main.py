@@ -8,7 +8,6 @@ from itertools import count
 from functools import wraps
 
 import numpy as np
-from scipy.optimize import OptimizeResult
 from toolz import compose
 import tableprint as tp
 
@@ -41,7 +40,7 @@ class Optimizer:
 
 
 class Consensus(Optimizer):
-    def __init__(self, tau=(10., 2., 2.), tol=(1e-6, 1e-3)):
+    def __init__(self, tau=(10., 2., 2.), tol=(1e-6, 1e-3), parallel=False):
         """
         Proximal Consensus (ADMM)
 
@@ -55,12 +54,18 @@ class Consensus(Optimizer):
 
         tol : (float, float)
             Primal and Dual residual tolerances
+
+        parallel : bool, optional
+            Whether or not to apply the proximal operators concurrently in a
+            shared thread pool (Default: False)
         """
         self.operators = []
+        self.parallel = parallel
         self.tau = namedtuple('tau', ('init', 'inc', 'dec'))(*tau)
         self.tol = namedtuple('tol', ('primal', 'dual'))(*tol)
 
     def minimize(self, x0, display=None, maxiter=np.Inf):
+        from scipy.optimize import OptimizeResult
 
         self.theta = x0
         primals = [destruct(x0) for _ in self.operators]
@@ -75,8 +80,12 @@ class Consensus(Optimizer):
                 theta_prev = destruct(self.theta)
 
                 # update each primal variable
-                primals = [op(self.restruct(theta_prev - dual), rho).ravel()
-                           for op, dual in zip(self.operators, duals)]
+                inputs = [self.restruct(theta_prev - dual) for dual in duals]
+                if self.parallel:
+                    primals = proxops.parallel_apply(self.operators, inputs, rho)
+                else:
+                    primals = [op(x, rho) for op, x in zip(self.operators, inputs)]
+                primals = [primal.ravel() for primal in primals]
 
                 # average primal copies
                 theta_avg = np.mean(primals, axis=0)
@@ -133,6 +142,7 @@ def gradient_optimizer(coro):
             self.transform = compose(destruct, func, self.restruct)
 
         def minimize(self, f_df, x0, display=sys.stdout, maxiter=1e3):
+            from scipy.optimize import OptimizeResult
 
             self.display = display
             self.theta = x0
@@ -3,19 +3,45 @@ Proximal operators / mappings
 
 """
 import numpy as np
+import threading
+import warnings
 from abc import ABCMeta, abstractmethod
-from functools import wraps
-from scipy.optimize import minimize as scipy_minimize
-from scipy.sparse import spdiags
-from scipy.sparse.linalg import spsolve
-
-try:
-    from skimage.restoration import denoise_tv_bregman
-except ImportError:
-    print('Error: scikit-image not found. TVD will not work.')
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from inspect import signature
 
 __all__ = ['nucnorm', 'sparse', 'linsys', 'squared_error', 'identity',
-           'lbfgs', 'tvd', 'smooth', 'linear', 'fantope']
+           'lbfgs', 'tvd', 'smooth', 'linear', 'fantope', 'parallel_apply']
+
+# arrays smaller than this are not worth dispatching to the parallel kernels
+_JIT_MIN_SIZE = 100000
+
+
+@lru_cache(maxsize=None)
+def _load_kernels():
+    """Imports the numba kernels, or returns None if numba is not installed"""
+    try:
+        from . import _kernels
+    except ImportError:
+        return None
+    return _kernels
+
+
+def _jittable(x, out=None):
+    """Checks whether x (and out, if given) can be passed to the numba kernels"""
+
+    # the parallel kernels are not safe to launch from other python threads
+    # under numba's tbb and workqueue threading layers
+    if threading.current_thread() is not threading.main_thread():
+        return False
+
+    arrays = (x,) if out is None else (x, out)
+    for a in arrays:
+        if not isinstance(a, np.ndarray) or a.dtype != np.float64:
+            return False
+        if not a.flags.c_contiguous or a.size < _JIT_MIN_SIZE or a.shape != x.shape:
+            return False
+    return _load_kernels() is not None
 
 
 class ProximalOperatorBaseClass(metaclass=ABCMeta):
@@ -24,6 +50,39 @@ class ProximalOperatorBaseClass(metaclass=ABCMeta):
         raise NotImplementedError
 
 
+@lru_cache(maxsize=None)
+def _pool():
+    """Thread pool shared by calls to parallel_apply"""
+    return ThreadPoolExecutor()
+
+
+def parallel_apply(ops, xs, rho=1.0):
+    """
+    Applies a list of proximal operators concurrently, one per input
+
+    NumPy, SciPy and scikit-image release the GIL in their compiled kernels,
+    so expensive operators (e.g. nucnorm, lbfgs or tvd) applied to separate
+    copies of the parameters run in parallel threads.
+
+    Parameters
+    ----------
+    ops : list of ProximalOperatorBaseClass
+        The proximal operators to apply
+
+    xs : list of array_like
+        Inputs, one for each operator
+
+    rho : float
+        (default: 1.0)
+
+    Returns
+    -------
+    zs : list of array_like
+    """
+    futures = [_pool().submit(op, x, rho) for op, x in zip(ops, xs)]
+    return [f.result() for f in futures]
+
+
 def proxify(func):
     class ProxOp(ProximalOperatorBaseClass):
         """
@@ -36,7 +95,7 @@ def proxify(func):
             self.args = args
             self.kwargs = kwargs
 
-        def __call__(self, x, rho=1.0):
+        def __call__(self, x, rho=1.0, out=None):
             """
             Applies the proximal operator
 
@@ -48,18 +107,84 @@ def proxify(func):
             rho : float
                 (default: 1.0)
 
+            out : array_like, optional
+                Buffer to write the result into, only supported by operators
+                that can be computed in place (default: None)
+
             Returns
             -------
             z : array_like
             """
 
-            return func(x, rho, *self.args, **self.kwargs)
+            if out is None:
+                return func(x, rho, *self.args, **self.kwargs)
+
+            return func(x, rho, *self.args, out=out, **self.kwargs)
 
     return ProxOp
 
 
+def _randomized_svd(x, rank, n_iter=4, oversample=10):
+    """
+    Approximates the leading singular triples of a matrix using a randomized
+    range finder with subspace iteration (Halko et al. 2011)
+
+    Parameters
+    ----------
+    x : array_like
+        The matrix to decompose
+
+    rank : int
+        Number of singular triples to return
+
+    n_iter : int, optional
+        Number of power (subspace) iterations (Default: 4)
+
+    oversample : int, optional
+        Number of additional random vectors used to sample the range of x
+        (Default: 10)
+    """
+    from scipy.linalg import svd as scipy_svd
+
+    # a fixed seed keeps the proximal operator deterministic
+    omega = np.random.RandomState(0).randn(x.shape[1], rank + oversample)
+    Q = np.linalg.qr(x.dot(omega))[0]
+
+    for _ in range(n_iter):
+        Q = np.linalg.qr(x.T.dot(Q))[0]
+        Q = np.linalg.qr(x.dot(Q))[0]
+
+    # form Q^T x in Fortran order so LAPACK can factor it in place
+    B = x.T.dot(Q).T
+    u, s, v = scipy_svd(B, full_matrices=False, overwrite_a=True,
+                        check_finite=False, lapack_driver='gesdd')
+    return Q.dot(u[:, :rank]), s[:rank], v[:rank]
+
+
+def _truncated_svd(x, thresh, method='exact'):
+    """
+    Computes the singular triples of x with singular value above thresh
+
+    With method='randomized', a single randomized SVD of rank min(m, n) // 10
+    is tried first and kept if its smallest singular value is at or below the
+    threshold. Otherwise (or with method='exact') the full SVD is returned.
+    """
+    from scipy.linalg import svd as scipy_svd
+
+    if method == 'randomized':
+        u, s, v = _randomized_svd(x, max(min(x.shape) // 10, 1))
+        if s[-1] <= thresh:
+            return u, s, v
+
+    elif method != 'exact':
+        raise ValueError("method must be 'exact' or 'randomized'")
+
+    return scipy_svd(x, full_matrices=False, check_finite=False,
+                     lapack_driver='gesdd')
+
+
 @proxify
-def nucnorm(x, rho, penalty, newshape=None):
+def nucnorm(x, rho, penalty, newshape=None, method='exact'):
     """
     Nuclear norm
 
@@ -72,6 +197,14 @@ def nucnorm(x, rho, penalty, newshape=None):
         Desired shape of the parameters to apply the nuclear norm to. The given
         parameters are reshaped to an array with this shape, or not reshaped if
         the value of newshape is None. (Default: None)
+
+    method : string, optional
+        Either 'exact', which uses a full SVD, or 'randomized', which first
+        tries a randomized SVD of rank min(m, n) // 10 and falls back to the
+        full SVD if more singular values than that survive the threshold. The
+        randomized result is an approximation: it is accurate when the
+        spectrum decays quickly past penalty / rho, but can be far off for
+        slowly decaying (flat) spectra. (Default: 'exact')
     """
 
     orig_shape = x.shape
@@ -79,14 +212,16 @@ def nucnorm(x, rho, penalty, newshape=None):
     if newshape is not None:
         x = x.reshape(newshape)
 
-    u, s, v = np.linalg.svd(x, full_matrices=False)
+    u, s, v = _truncated_svd(x, penalty / rho, method)
     sthr = np.maximum(s - (penalty / rho), 0)
 
-    return np.linalg.multi_dot((u, np.diag(sthr), v)).reshape(orig_shape)
+    # singular values are sorted, so only the leading r components survive
+    r = np.count_nonzero(sthr)
+    return (u[:, :r] * sthr[:r]).dot(v[:r]).reshape(orig_shape)
 
 
 @proxify
-def sparse(x, rho, penalty):
+def sparse(x, rho, penalty, out=None):
     """
     Proximal operator for the l1-norm: soft thresholding
 
@@ -97,11 +232,21 @@ def sparse(x, rho, penalty):
     """
 
     lmbda = penalty / rho
-    return (x - lmbda) * (x >= lmbda) + (x + lmbda) * (x <= -lmbda)
+
+    if _jittable(x, out):
+        z = np.empty_like(x) if out is None else out
+        _load_kernels().soft_threshold(x.ravel(), lmbda, z.ravel())
+        return z
+
+    if out is None:
+        return np.where(np.abs(x) <= lmbda, 0., x - np.copysign(lmbda, x))
+
+    # x - clip(x, -lmbda, lmbda) needs a single temporary, and out may alias x
+    return np.subtract(x, np.clip(x, -lmbda, lmbda), out=out)
 
 
 class linsys(ProximalOperatorBaseClass):
-    def __init__(self, A, b):
+    def __init__(self, A, b, tol=1e-8):
         """
         Proximal operator for solving a linear least squares system, Ax = b
 
@@ -112,18 +257,78 @@ class linsys(ProximalOperatorBaseClass):
 
         b : array_like
             Responses (Ax = b)
+
+        tol : float, optional
+            Relative tolerance of the conjugate gradient solver, only used when
+            A is sparse (Default: 1e-8)
+
+        Notes
+        -----
+        If A is a scipy.sparse matrix, A^T A is never formed and the proximal
+        update is instead solved with (Jacobi preconditioned) conjugate gradient
         """
+        from scipy.sparse import issparse
 
-        self.P = A.T.dot(A)
         self.q = A.T.dot(b)
         self.n = self.q.size
 
+        if issparse(A):
+            from scipy.sparse.linalg import cg
+
+            self.A = A.tocsr()
+            self.P = None
+            self.colnorms = np.asarray(self.A.multiply(self.A).sum(axis=0)).ravel()
+
+            # scipy < 1.12 names the relative tolerance tol instead of rtol
+            self._cg_tol = {'rtol' if 'rtol' in signature(cg).parameters else 'tol': tol}
+        else:
+            self.P = A.T.dot(A)
+
+            # workspace for (rho * I + P), overwritten by its factorization
+            self._M = np.empty(self.P.shape, order='F')
+
+        # cholesky factorization of (rho * I + P), keyed on rho
+        self._factor = (None, None)
+
     def __call__(self, x, rho):
-        return np.linalg.solve(rho * np.eye(self.n) + self.P, rho * x + self.q)
+        from scipy.linalg import cho_factor, cho_solve
+
+        if self.P is None:
+            return self._cg(x, rho)
+
+        # rho is typically fixed across iterations, so reuse the factorization
+        if self._factor[0] != rho:
+            np.copyto(self._M, self.P)
+            self._M.flat[::self.n + 1] += rho
+            factor = cho_factor(self._M, overwrite_a=True, check_finite=False)
+            self._factor = (rho, factor)
+
+        return cho_solve(self._factor[1], rho * x + self.q, check_finite=False)
+
+    def _cg(self, x, rho):
+        """Solves (rho * I + A^T A) z = rho * x + q, warm started at x"""
+        from scipy.sparse.linalg import LinearOperator, cg
+
+        A = self.A
+        op = LinearOperator((self.n, self.n), dtype=float,
+                            matvec=lambda z: rho * z + A.T.dot(A.dot(z)))
+        diag = rho + self.colnorms
+        diag[diag == 0] = 1.
+        precond = LinearOperator((self.n, self.n), dtype=float,
+                                 matvec=lambda z: z / diag)
+        z, info = cg(op, rho * x + self.q, x0=x, M=precond, atol=0., **self._cg_tol)
+
+        if info > 0:
+            warnings.warn('linsys: conjugate gradient did not converge in {} '
+                          'iterations'.format(info), RuntimeWarning)
+        elif info < 0:
+            raise ValueError('linsys: conjugate gradient broke down (illegal input)')
+
+        return z
 
 
 @proxify
-def squared_error(x, rho, x_obs):
+def squared_error(x, rho, x_obs, out=None):
     """
     Proximal operator for squared error (l2 or Fro. norm)
 
@@ -134,7 +339,19 @@ def squared_error(x, rho, x_obs):
     x_obs : array_like
         Observed array or matrix that you want to stay close to
     """
-    return (x + x_obs / rho) / (1. + 1. / rho)
+    # (x + x_obs / rho) / (1 + 1 / rho), computed with a single allocation
+    if out is None:
+        z = np.empty(np.broadcast(x, x_obs).shape, np.result_type(x, x_obs, float(rho)))
+        np.divide(x_obs, rho, out=z)
+        z += x
+        z *= rho / (1. + rho)
+        return z
+
+    # (rho * x + x_obs) / (1 + rho), reading x first so that out may alias it
+    z = np.multiply(x, rho, out=out)
+    z += x_obs
+    z /= 1. + rho
+    return z
 
 
 @proxify
@@ -150,11 +367,13 @@ def lbfgs(x, rho, f_df, maxiter=20):
     maxiter : int
         Maximum number of L-BFGS iterations
     """
+    from scipy.optimize import minimize as scipy_minimize
 
     def f_df_augmented(theta):
         f, df = f_df(theta)
-        obj = f + (rho / 2.) * np.linalg.norm(theta - x) ** 2
-        grad = df + rho * (theta - x)
+        d = theta - x
+        obj = f + (rho / 2.) * np.ravel(d).dot(np.ravel(d))
+        grad = df + rho * d
         return obj, grad
 
     res = scipy_minimize(f_df_augmented, x, jac=True, method='L-BFGS-B',
@@ -164,22 +383,43 @@ def lbfgs(x, rho, f_df, maxiter=20):
 
 
 @proxify
-def tvd(x, rho, penalty):
+def tvd(x, rho, penalty, batch_axis=None):
     """
     Total variation denoising proximal operator
 
     Parameters
     ----------
     penalty : float
+
+    batch_axis : int, optional
+        If given, each slice of the parameters along this axis is denoised
+        independently, and the slices are processed in parallel threads.
+        (Default: None)
     """
+    from skimage.restoration import denoise_tv_bregman
+
+    weight = rho / penalty
 
-    return denoise_tv_bregman(x, rho / penalty)
+    if batch_axis is None:
+        return denoise_tv_bregman(x, weight)
+
+    # the denoising kernel releases the GIL, so slices run concurrently
+    with ThreadPoolExecutor() as executor:
+        slices = executor.map(lambda xi: denoise_tv_bregman(xi, weight),
+                              np.moveaxis(x, batch_axis, 0))
+        return np.moveaxis(np.stack(list(slices)), 0, batch_axis)
 
 
 @proxify
-def nonneg(x, rho):
+def nonneg(x, rho, out=None):
     """Projection onto the non-negative orthant"""
-    return np.maximum(x, 0)
+
+    if _jittable(x, out):
+        z = np.empty_like(x) if out is None else out
+        _load_kernels().clip_negative(x.ravel(), z.ravel())
+        return z
+
+    return np.maximum(x, 0, out=out)
 
 
 @proxify
@@ -201,6 +441,7 @@ def smooth(x, rho, penalty, axis=0, newshape=None):
         parameters are reshaped to an array with this shape, or not reshaped if
         the value of newshape is None. (Default: None)
     """
+    from scipy.linalg import solveh_banded
 
     orig_shape = x.shape
 
@@ -208,22 +449,29 @@ def smooth(x, rho, penalty, axis=0, newshape=None):
         x = x.reshape(newshape)
 
     # Apply Laplacian smoothing (l2 norm on the parameters multiplied by
-    # the laplacian)
+    # the laplacian). The system is symmetric positive definite and
+    # tridiagonal, so it is stored in upper banded form and solved with a
+    # banded cholesky
     n = x.shape[axis]
-    lap_op = spdiags([(2 + rho / penalty) * np.ones(n),
-                      -1 * np.ones(n), -1 * np.ones(n)],
-                     [0, -1, 1], n, n, format='csc')
+    ab = np.empty((2, n))
+    ab[0] = -penalty
+    ab[1] = 2 * penalty + rho
 
-    A = penalty * lap_op
-    b = rho * np.rollaxis(x, axis, 0)
-    return np.rollaxis(spsolve(A, b), axis, 0).reshape(orig_shape)
+    b = rho * np.moveaxis(x, axis, 0)
+    z = solveh_banded(ab, b.reshape(n, -1), overwrite_ab=True,
+                      overwrite_b=True, check_finite=False)
+    return np.moveaxis(z.reshape(b.shape), 0, axis).reshape(orig_shape)
 
 
 @proxify
 def sdcone(x, rho):
     """Projection onto the semidefinite cone"""
     U, V = np.linalg.eigh(x)
-    return V.dot(np.diag(np.maximum(U, 0)).dot(V.T))
+
+    # eigenvalues are in ascending order, so keep the trailing positive ones
+    k = np.searchsorted(U, 0, side='right')
+    Vp = V[:, k:]
+    return (Vp * U[k:]).dot(Vp.T)
 
 
 @proxify
@@ -3,7 +3,10 @@ Test proximal operators
 """
 from descent import proxops
 import numpy as np
+import os
 import pytest
+import subprocess
+import sys
 
 
 def randomseed(func):
@@ -44,10 +47,56 @@ def test_nucnorm():
     assert np.abs(nn(X) - nn(v.reshape(X.shape)) - pen / rho) <= tol
 
 
+@randomseed
+def test_nucnorm_large():
+    pen = 5.
+    rho = 0.1
+
+    X = np.random.randn(800, 10).dot(np.random.randn(10, 600))
+    V = X + 0.5 * np.random.randn(800, 600)
+
+    # proximal operator computed with a full SVD
+    u, s, v = np.linalg.svd(V, full_matrices=False)
+    expected = (u * np.maximum(s - pen / rho, 0)).dot(v)
+
+    op = proxops.nucnorm(pen, method='randomized')
+    assert np.allclose(op(V, rho), expected)
+
+
+@randomseed
+def test_nucnorm_slow_decay():
+    rho = 1.
+
+    # matrix with a slowly decaying spectrum, s_i = 100 / sqrt(i)
+    U = np.linalg.qr(np.random.randn(800, 600))[0]
+    W = np.linalg.qr(np.random.randn(600, 600))[0]
+    s = 100. / np.sqrt(np.arange(1, 601))
+    V = (U * s).dot(W.T)
+
+    def exact(pen):
+        return (U * np.maximum(s - pen / rho, 0)).dot(W.T)
+
+    # the exact method is the default
+    assert np.allclose(proxops.nucnorm(10.)(V, rho), exact(10.))
+
+    # ~100 singular values survive, more than the randomized rank, so this
+    # falls back to the full SVD
+    op = proxops.nucnorm(10., method='randomized')
+    assert np.allclose(op(V, rho), exact(10.))
+
+    # with fewer survivors the randomized result is only an approximation
+    op = proxops.nucnorm(30., method='randomized')
+    err = np.linalg.norm(op(V, rho) - exact(30.)) / np.linalg.norm(exact(30.))
+    assert err <= 1e-3
+
+    with pytest.raises(ValueError):
+        proxops.nucnorm(10., method='lanczos')(V, rho)
+
+
 def test_sparse():
     pen = 0.1
     rho = 0.1
-    v = np.linspace(-5, 5, 1e3)
+    v = np.linspace(-5, 5, 1000)
 
     gamma = pen / rho
     x = (v - gamma * np.sign(v)) * (np.abs(v) > gamma)
@@ -57,6 +106,35 @@ def test_sparse():
     assert np.allclose(op(v, rho), x)
 
 
+@randomseed
+def test_sparse_large():
+    pen = 0.1
+    rho = 0.1
+    v = 5 * np.random.randn(500, 500)
+    v[0, :10] = np.nan
+
+    gamma = pen / rho
+    x = np.where(np.abs(v) <= gamma, 0., v - gamma * np.sign(v))
+
+    op = proxops.sparse(pen)
+
+    assert np.allclose(op(v, rho), x, equal_nan=True)
+
+    # test writing the result in place
+    op(v, rho, out=v)
+    assert np.allclose(v, x, equal_nan=True)
+
+    # test scalar and 0-d inputs
+    assert np.allclose(op(3.0, rho), 2.0)
+    assert np.allclose(op(np.array(-3.0), rho), -2.0)
+
+    # NaN propagates, with or without an output buffer
+    v = np.array([np.nan, 2., -0.5])
+    x = np.array([np.nan, 1., 0.])
+    assert np.allclose(op(v, rho), x, equal_nan=True)
+    assert np.allclose(op(v, rho, out=v), x, equal_nan=True)
+
+
 def test_nonneg():
     op = proxops.nonneg()
 
@@ -66,6 +144,14 @@ def test_nonneg():
     # test the proximal map (projection onto the non-negative orthant)
     assert np.allclose(op(v, 1.), x)
 
+    # test writing the projection in place
+    op(v, 1., out=v)
+    assert np.allclose(v, x)
+
+    # test a large array
+    v = np.tile([-2., 0.54, -0.2, 24.], 100000).reshape(-1, 4)
+    assert np.allclose(op(v, 1.), np.tile(x, 100000).reshape(-1, 4))
+
 
 @randomseed
 def test_linsys():
@@ -89,6 +175,23 @@ def test_squared_error():
     assert np.allclose(op(xobs, 10.), xobs)
     assert np.linalg.norm(op(np.zeros(5), 1e-6) - xobs) <= tol
 
+    # test writing the result in place
+    x = np.zeros(5)
+    op(x, 1., out=x)
+    assert np.allclose(x, np.array([-1., -0.5, 0., 0.5, 1.]))
+
+    # the result has the promoted dtype of x and x_obs
+    assert op(np.zeros(5, dtype=np.float32), 1.).dtype == np.float64
+
+    # x may broadcast against x_obs, in either direction
+    op = proxops.squared_error(np.tile(xobs, (3, 1)))
+    assert np.allclose(op(np.zeros(5), 1.), np.tile(xobs / 2., (3, 1)))
+    op = proxops.squared_error(xobs)
+    assert np.allclose(op(np.zeros((3, 5)), 1.), np.tile(xobs / 2., (3, 1)))
+
+    # complex inputs
+    assert np.allclose(op(1j * np.ones(5), 1.), (xobs + 1j) / 2.)
+
 
 @randomseed
 def test_smooth():
@@ -103,6 +206,22 @@ def test_smooth():
     assert np.linalg.norm(x_true - x_smooth) < np.linalg.norm(x_true - x_obs)
 
 
+@randomseed
+def test_tvd():
+    denoise = pytest.importorskip('skimage.restoration').denoise_tv_bregman
+    rho = 1.
+    pen = 0.1
+
+    X = np.random.randn(20, 20, 4)
+    op = proxops.tvd(pen)
+    assert np.allclose(op(X, rho), denoise(X, rho / pen))
+
+    # denoise each slice along the last axis independently
+    op = proxops.tvd(pen, batch_axis=2)
+    expected = np.stack([denoise(X[:, :, k], rho / pen) for k in range(4)], axis=2)
+    assert np.allclose(op(X, rho), expected)
+
+
 def test_lbfgs():
     # simple objective (quadratic)
     def f_df(x):
@@ -140,3 +259,49 @@ def test_linear():
     weights = np.array([-1., 1., 0., -2., 2.])
     op = proxops.linear(weights)
     assert np.allclose(op(x, 0.5), x - 2 * weights)
+
+
+@randomseed
+def test_linsys_sparse():
+    from scipy.sparse import random as sprandom
+    A = sprandom(200, 50, density=0.1, format='csr') + \
+        sprandom(200, 50, density=0.1, format='csr')
+    x = np.random.randn(50,)
+    y = A.dot(x)
+
+    op = proxops.linsys(A, y)
+    dense = proxops.linsys(A.toarray(), y)
+
+    assert np.allclose(op(x, 1.), x)
+    v = np.random.randn(50,)
+    assert np.allclose(op(v, 0.5), dense(v, 0.5))
+
+    # an unreachable tolerance warns instead of silently returning
+    op = proxops.linsys(A, y, tol=1e-300)
+    with pytest.warns(RuntimeWarning):
+        op(v, 0.5)
+
+
+def test_parallel_apply():
+    ops = [proxops.nonneg(), proxops.sparse(1.), proxops.identity()]
+    xs = [np.array([-2., 0.5, 3.])] * 3
+
+    expected = [op(x, 1.) for op, x in zip(ops, xs)]
+    for z, e in zip(proxops.parallel_apply(ops, xs, 1.), expected):
+        assert np.allclose(z, e)
+
+
+def test_parallel_apply_large():
+    # runs in a subprocess, since a hang or abort at interpreter exit is the failure
+    script = "\n".join([
+        "import numpy as np",
+        "from descent import proxops",
+        "ops = [proxops.sparse(0.1), proxops.nonneg()]",
+        "xs = [np.random.randn(400000)] * 2",
+        "zs = proxops.parallel_apply(ops, xs, 1.)",
+        "assert np.allclose(zs[0], ops[0](xs[0], 1.))",
+        "assert np.allclose(zs[1], np.maximum(xs[1], 0))",
+    ])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([sys.executable, "-c", script], cwd=root, timeout=60)
+    assert proc.returncode == 0
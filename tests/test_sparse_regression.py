@@ -115,3 +115,19 @@ def test_consensus():
 
     # test
     assert relative_error(res.x, x_true, ls_error) <= 0.05
+
+
+def test_consensus_parallel():
+    """Test the consensus optimizer (ADMM) with concurrent proximal updates"""
+
+    A, y, x_true, xls, ls_error = generate_sparse_system()
+
+    results = []
+    for parallel in (False, True):
+        opt = Consensus(parallel=parallel)
+        opt.add(linsys(A, y))
+        opt.add(sparse(10.0))
+        results.append(opt.minimize(xls, display=None, maxiter=5000).x)
+
+    # the updates are independent, so the result should not change
+    assert np.allclose(*results)